@@ -1,10 +1,23 @@
 import os
 import io
-import yfinance as yf
+import csv
+import asyncio
+import glob
+import json
+import contextlib
+import time
+import random
+import tempfile
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import matplotlib
+matplotlib.use('Agg')  # 无界面渲染，避免 CI 上加载 Tk/Qt
 import matplotlib.pyplot as plt
 from datetime import datetime, timezone
-import smtplib, requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import smtplib
+import httpx
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
@@ -18,6 +31,24 @@ INDEXES = {
     "^DJI": "道琼斯工业指数"
 }
 
+# 切换到 Parquet 之前使用的 CSV 历史数据文件
+LEGACY_DATA_FILE = 'market_daily.csv'
+
+# 当日行情缓存（cache_<日期>_<区间>.json）的有效期（秒）
+DAILY_CACHE_TTL = 3600
+
+# 日报中每个指数的一行摘要
+_ROW_FMT = "{Name} ({Ticker}): 开盘 {Open:.2f}, 收盘 {Close:.2f}, 涨跌幅 {pct:+.2f}%".format
+
+# =============================
+#  HTTP 请求设置（行情抓取 / Webhook 推送）
+# =============================
+HTTP_TIMEOUT = httpx.Timeout(10, connect=3)
+WEBHOOK_RETRY_STATUS = {429, 500, 502, 503, 504}
+WEBHOOK_MAX_RETRY_DELAY = 30  # 单次重试最长等待（秒）
+YAHOO_CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
+YAHOO_HEADERS = {'User-Agent': 'Mozilla/5.0'}
+
 # =============================
 #  获取配置（从环境变量）
 # =============================
@@ -34,61 +65,225 @@ def get_config():
         'TELEGRAM_CHAT_ID': os.getenv('TELEGRAM_CHAT_ID'),
         'DISCORD_WEBHOOK_URL': os.getenv('DISCORD_WEBHOOK_URL'),
         'WECHAT_WEBHOOK_URL': os.getenv('WECHAT_WEBHOOK_URL'),
-        'DATA_FILE': 'market_daily.csv'
+        # 无警报时是否仍在邮件中附带走势图
+        'SEND_DAILY_CHART': os.getenv('SEND_DAILY_CHART', '1').lower() not in ('0', 'false', 'no'),
+        # 后缀为 .csv 时使用 CSV，否则按 Parquet 数据集存储
+        'DATA_FILE': os.getenv('DATA_FILE', 'market_daily.parquet')
     }
 
 # =============================
 #  获取行情数据
 # =============================
-def get_latest_data(ticker):
-    stock = yf.Ticker(ticker)
-    hist = stock.history(period="5d")
-    if hist.empty:
-        print(f"❌ {ticker} 无数据")
-        return None
-    latest = hist.iloc[-1]
-    latest_date = latest.name.tz_convert('UTC').date()
-    today_utc = datetime.now(timezone.utc).date()
-    if latest_date != today_utc:
-        print(f"📅 {ticker} 最新日期 {latest_date} ≠ {today_utc}，跳过")
-        return None
-    return latest, hist
+def _parse_chart(payload):
+    # 将 Yahoo chart 接口的 JSON 直接转换为 K 线列表，跳过未收盘的空值
+    result = (payload.get('chart') or {}).get('result') or []
+    if not result:
+        return []
+    quote = result[0]['indicators']['quote'][0]
+    bars = []
+    for i, ts in enumerate(result[0].get('timestamp') or []):
+        if quote['open'][i] is None or quote['close'][i] is None:
+            continue
+        bars.append({
+            'Date': datetime.fromtimestamp(ts, timezone.utc),
+            'Open': quote['open'][i],
+            'High': quote['high'][i],
+            'Low': quote['low'][i],
+            'Close': quote['close'][i],
+            'Volume': quote['volume'][i]
+        })
+    return bars
+
+async def _fetch_chart(client, ticker, period):
+    resp = await client.get(YAHOO_CHART_URL.format(symbol=ticker), params={'range': period, 'interval': '1d'})
+    resp.raise_for_status()
+    return _parse_chart(resp.json())
+
+async def _fetch_all(tickers, period, proxy):
+    # 所有指数在同一个 HTTP/2 连接上并发请求
+    async with httpx.AsyncClient(
+        http2=True, timeout=HTTP_TIMEOUT, headers=YAHOO_HEADERS, proxy=proxy
+    ) as client:
+        return await asyncio.gather(
+            *(_fetch_chart(client, t, period) for t in tickers),
+            return_exceptions=True
+        )
+
+def download_history(tickers, period, attempts=3):
+    # 被限流时随机退避后重试失败的指数，并依次切换 YF_PROXIES 中的代理（逗号分隔）
+    proxies = iter([p.strip() for p in os.getenv('YF_PROXIES', '').split(',') if p.strip()])
+    proxy = None
+    hists, pending = {}, list(tickers)
+    for attempt in range(1, attempts + 1):
+        errors = {}
+        for ticker, result in zip(pending, asyncio.run(_fetch_all(pending, period, proxy))):
+            if isinstance(result, Exception):
+                errors[ticker] = result
+            else:
+                hists[ticker] = result
+        if not errors:
+            break
+        print(f"⚠️ 第 {attempt} 次下载失败: {errors}")
+        pending = list(errors)
+        if attempt < attempts:
+            time.sleep(random.uniform(3, 10))
+            proxy = next(proxies, None)
+    return hists
+
+def _daily_cache_path(today_utc, period):
+    return f"cache_{today_utc.isoformat()}_{period}.json"
+
+def _purge_stale_caches(today_utc):
+    # 删除往日遗留的缓存文件
+    for f in glob.glob("cache_*.json"):
+        if not f.startswith(f"cache_{today_utc.isoformat()}_"):
+            with contextlib.suppress(OSError):
+                os.remove(f)
+
+def load_daily_cache(today_utc, period):
+    # 短时间内的重试 / 并发运行直接复用已抓取的数据；
+    # 超过 DAILY_CACHE_TTL 的缓存可能是盘中数据，重新抓取
+    path = _daily_cache_path(today_utc, period)
+    try:
+        if time.time() - os.path.getmtime(path) > DAILY_CACHE_TTL:
+            return {}
+    except OSError:
+        return {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            raw = json.load(f)
+        return {
+            t: [dict(bar, Date=datetime.fromisoformat(bar['Date'])) for bar in bars]
+            for t, bars in raw.items()
+        }
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"⚠️ 读取当日缓存失败: {e}")
+        return {}
+
+def save_daily_cache(today_utc, period, hists):
+    path = _daily_cache_path(today_utc, period)
+    _purge_stale_caches(today_utc)
+    payload = {
+        t: [dict(bar, Date=bar['Date'].isoformat()) for bar in hist]
+        for t, hist in hists.items()
+    }
+    # 每个进程使用独立的临时文件，并发写入时互不覆盖
+    tmp = None
+    try:
+        with tempfile.NamedTemporaryFile(
+            'w', encoding='utf-8', dir='.', prefix=path + '.', suffix='.tmp', delete=False
+        ) as f:
+            tmp = f.name
+            json.dump(payload, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"⚠️ 写入当日缓存失败: {e}")
+        if tmp:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+
+def get_all_latest(tickers, today_utc, with_chart=False):
+    # 只取最新一根 K 线时拉 2 天即可；需要画图时拉 7 天，同一份数据两用
+    period = "7d" if with_chart else "2d"
+    cached = load_daily_cache(today_utc, period)
+    results = {t: (cached[t][-1], cached[t]) for t in tickers if t in cached}
+    missing = [t for t in tickers if t not in results]
+    if not missing:
+        print("♻️ 使用当日缓存数据")
+        return results
+
+    fetched = download_history(missing, period)
+    for ticker in missing:
+        hist = fetched.get(ticker)
+        if not hist:
+            print(f"❌ {ticker} 无数据")
+            continue
+        latest = hist[-1]
+        latest_date = latest['Date'].date()
+        if latest_date != today_utc:
+            print(f"📅 {ticker} 最新日期 {latest_date} ≠ {today_utc}，跳过")
+            continue
+        results[ticker] = (latest, hist)
+
+    if len(results) > len(cached):
+        save_daily_cache(today_utc, period, {t: hist for t, (_, hist) in results.items()})
+    return results
 
 # =============================
 #  生成走势图
 # =============================
-def make_chart(ticker, hist):
+def make_charts(hists):
+    # 复用同一个 Figure，避免每个指数重复创建画布
+    charts = {}
     fig, ax = plt.subplots(figsize=(6, 4))
-    hist['Close'].plot(ax=ax, linewidth=2)
-    ax.set_title(f"{INDEXES[ticker]} 近7日走势", fontsize=12)
-    ax.grid(True, linestyle='--', alpha=0.4)
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight')
+    # 固定边距代替 bbox_inches='tight'，省去保存时的二次测量渲染
+    fig.subplots_adjust(left=0.1, right=0.95, top=0.9, bottom=0.12)
+    for ticker, hist in hists.items():
+        ax.clear()
+        # 仅在画图时才把收盘价构造成 Series
+        closes = pd.Series(
+            [bar['Close'] for bar in hist],
+            index=pd.DatetimeIndex([bar['Date'] for bar in hist])
+        )
+        closes.plot(ax=ax, linewidth=2)
+        ax.set_title(f"{INDEXES[ticker]} 近7日走势", fontsize=12)
+        ax.grid(True, linestyle='--', alpha=0.4)
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', dpi=80)
+        charts[ticker] = buf.getvalue()
     plt.close(fig)
-    buf.seek(0)
-    return buf
+    return charts
 
 # =============================
 #  邮件发送函数
 # =============================
-def send_email(config, subject, body, charts):
-    if not config['SMTP_SERVER']:
-        print("⚠️ 未配置 SMTP，跳过邮件发送")
-        return
+class SmtpClient:
+    # 进入时完成一次连接 / STARTTLS / 登录，之后多封邮件复用同一连接
+    def __init__(self, config):
+        self.config = config
+        self._smtp = None
+
+    def __enter__(self):
+        smtp = smtplib.SMTP(self.config['SMTP_SERVER'], self.config['SMTP_PORT'])
+        try:
+            smtp.starttls()
+            smtp.login(self.config['SMTP_USERNAME'], self.config['SMTP_PASSWORD'])
+        except Exception:
+            smtp.close()
+            raise
+        self._smtp = smtp
+        return self
+
+    def send(self, msg):
+        self._smtp.send_message(msg)
+
+    def __exit__(self, exc_type, exc, tb):
+        # 连接已被重置时 quit() 会抛出 OSError，不能因此掩盖原始异常
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        finally:
+            self._smtp.close()
+            self._smtp = None
+
+def build_email(config, subject, body, charts):
     msg = MIMEMultipart()
     msg['From'] = config['EMAIL_FROM']
     msg['To'] = config['EMAIL_TO']
     msg['Subject'] = subject
     msg.attach(MIMEText(body, 'plain', 'utf-8'))
     for name, chart in charts.items():
-        img = MIMEImage(chart.read())
+        img = MIMEImage(chart)
         img.add_header('Content-ID', f"<{name}>")
         msg.attach(img)
+    return msg
+
+def send_email(config, *messages):
     try:
-        with smtplib.SMTP(config['SMTP_SERVER'], config['SMTP_PORT']) as s:
-            s.starttls()
-            s.login(config['SMTP_USERNAME'], config['SMTP_PASSWORD'])
-            s.send_message(msg)
+        with SmtpClient(config) as smtp:
+            for msg in messages:
+                smtp.send(msg)
         print("✅ 邮件发送成功")
     except Exception as e:
         print(f"❌ 邮件发送失败: {e}")
@@ -96,28 +291,52 @@ def send_email(config, subject, body, charts):
 # =============================
 #  其他推送方式
 # =============================
-def send_telegram(config, text):
+def _retry_delay(resp, attempt):
+    # 优先遵循服务端给出的等待时间：Retry-After 头，或 JSON 中的 retry_after
+    # （Discord 在顶层，Telegram 在 parameters 内），否则按指数退避
+    delay = resp.headers.get('Retry-After')
+    if delay is None and resp.status_code == 429:
+        with contextlib.suppress(ValueError):
+            body = resp.json()
+            if isinstance(body, dict):
+                delay = body.get('retry_after') or (body.get('parameters') or {}).get('retry_after')
+    try:
+        return min(float(delay), WEBHOOK_MAX_RETRY_DELAY)
+    except (TypeError, ValueError):
+        return 0.5 * 2 ** attempt
+
+async def _post(client, url, attempts=3, **kwargs):
+    # 限流 / 服务端错误时重试 POST（传输层只重试连接失败），
+    # 重试耗尽或其他错误状态码时抛出异常，由调用方记录推送失败
+    for attempt in range(attempts):
+        resp = await client.post(url, **kwargs)
+        if resp.status_code not in WEBHOOK_RETRY_STATUS or attempt == attempts - 1:
+            resp.raise_for_status()
+            return resp
+        await asyncio.sleep(_retry_delay(resp, attempt))
+
+async def send_telegram(client, config, text):
     if not config['TELEGRAM_BOT_TOKEN']:
         return
     url = f"https://api.telegram.org/bot{config['TELEGRAM_BOT_TOKEN']}/sendMessage"
     try:
-        requests.post(url, data={'chat_id': config['TELEGRAM_CHAT_ID'], 'text': text})
+        await _post(client, url, data={'chat_id': config['TELEGRAM_CHAT_ID'], 'text': text})
         print("✅ Telegram 推送成功")
     except Exception as e:
         print(f"❌ Telegram 推送失败: {e}")
 
-def send_discord(config, text):
+async def send_discord(client, config, text):
     if config['DISCORD_WEBHOOK_URL']:
         try:
-            requests.post(config['DISCORD_WEBHOOK_URL'], json={"content": text})
+            await _post(client, config['DISCORD_WEBHOOK_URL'], json={"content": text})
             print("✅ Discord 推送成功")
         except Exception as e:
             print(f"❌ Discord 推送失败: {e}")
 
-def send_wechat(config, text):
+async def send_wechat(client, config, text):
     if config['WECHAT_WEBHOOK_URL']:
         try:
-            requests.post(config['WECHAT_WEBHOOK_URL'], json={
+            await _post(client, config['WECHAT_WEBHOOK_URL'], json={
                 "msgtype": "text",
                 "text": {"content": text}
             })
@@ -125,33 +344,112 @@ def send_wechat(config, text):
         except Exception as e:
             print(f"❌ 企业微信推送失败: {e}")
 
+WEBHOOK_SENDERS = [
+    (send_telegram, 'TELEGRAM_BOT_TOKEN'),
+    (send_discord, 'DISCORD_WEBHOOK_URL'),
+    (send_wechat, 'WECHAT_WEBHOOK_URL'),
+]
+
+def enabled_webhooks(config):
+    return [fn for fn, key in WEBHOOK_SENDERS if config[key]]
+
+async def notify_all(config, text, senders):
+    # 一个事件循环内并发推送，共享同一个 HTTP/2 连接池
+    transport = httpx.AsyncHTTPTransport(http2=True, retries=2)
+    async with httpx.AsyncClient(transport=transport, timeout=HTTP_TIMEOUT) as client:
+        await asyncio.gather(
+            *(fn(client, config, text) for fn in senders),
+            return_exceptions=True
+        )
+
+def send_webhooks(config, text, senders):
+    asyncio.run(notify_all(config, text, senders))
+
 # =============================
-#  保存 CSV
+#  保存历史数据
 # =============================
+def _drop_existing(df_new, existing):
+    # 按 (Date, Ticker) 键过滤已存在的行，无需拼接整表再 drop_duplicates
+    keys = pd.MultiIndex.from_arrays([existing['Date'], existing['Ticker'].astype(str)])
+    new_keys = pd.MultiIndex.from_arrays([df_new['Date'], df_new['Ticker']])
+    return df_new[~new_keys.isin(keys)]
+
+def _read_csv_tail(path, n=10, block=4096):
+    # 只读取表头和文件末尾几 KB，避免解析整份历史数据
+    with open(path, 'rb') as f:
+        header = next(csv.reader([f.readline().decode('utf-8')]))
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - block))
+        # 第一行可能是表头或被截断的半行，直接丢弃
+        lines = f.read().decode('utf-8', errors='ignore').splitlines()[1:]
+    rows = [r for r in csv.reader(lines[-n:]) if len(r) == len(header)]
+    return header, pd.DataFrame(rows, columns=header)
+
+def save_csv(path, df_new):
+    if not os.path.exists(path):
+        df_new.to_csv(path, index=False)
+        return True
+    # 历史数据只追加，仅对比末尾几行去重，不再整表读写
+    header, last = _read_csv_tail(path)
+    df_new = _drop_existing(df_new, last)
+    if df_new.empty:
+        return False
+    df_new.reindex(columns=header).to_csv(path, mode='a', header=False, index=False)
+    return True
+
+def _read_existing(path, tickers):
+    # 只读取本次涉及的指数分区；首次写入时导入旧版 CSV 历史数据
+    if os.path.exists(path):
+        existing = pq.read_table(path, filters=[('Ticker', 'in', list(tickers))]).to_pandas()
+        return existing.assign(Ticker=existing['Ticker'].astype(str))
+    if os.path.exists(LEGACY_DATA_FILE):
+        legacy = pd.read_csv(LEGACY_DATA_FILE, dtype={'Date': str, 'Ticker': str})
+        print(f"📥 已从 {LEGACY_DATA_FILE} 导入 {len(legacy)} 行历史数据")
+        return legacy.assign(Date=pd.to_datetime(legacy['Date']))
+    return None
+
+def save_parquet(path, df_new):
+    # Date 保存为日期类型，读取时无需再解析
+    df_new = df_new.assign(Date=pd.to_datetime(df_new['Date']))
+    existing = _read_existing(path, df_new['Ticker'].unique())
+    if existing is not None:
+        # 以 (Date, Ticker) 为键 upsert：新数据覆盖同一天的旧数据
+        df_new = pd.concat([_drop_existing(existing, df_new), df_new], ignore_index=True)
+    # 每个指数分区只保留一个固定文件名的文件，整体重写
+    pq.write_to_dataset(
+        pa.Table.from_pandas(df_new.sort_values(['Ticker', 'Date']), preserve_index=False),
+        root_path=path, partition_cols=['Ticker'],
+        basename_template="part-{i}.parquet",
+        existing_data_behavior='delete_matching'
+    )
+    return True
+
 def save_data(config, rows):
+    path = config['DATA_FILE']
     df_new = pd.DataFrame(rows)
-    if os.path.exists(config['DATA_FILE']):
-        existing = pd.read_csv(config['DATA_FILE'])
-        df = pd.concat([existing, df_new]).drop_duplicates(subset=['Date', 'Ticker'])
-    else:
-        df = df_new
-    df.to_csv(config['DATA_FILE'], index=False)
-    print(f"💾 数据已保存至 {config['DATA_FILE']}")
+    saver = save_csv if path.endswith('.csv') else save_parquet
+    if not saver(path, df_new):
+        print(f"ℹ️ 今日数据已存在于 {path}，无需写入")
+        return
+    print(f"💾 数据已保存至 {path}")
 
 # =============================
 #  主程序逻辑
 # =============================
 def main():
     config = get_config()
-    all_rows, alerts, charts = [], [], {}
-    today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    all_rows, alerts, charts, hists = [], [], {}, {}
+    today_utc = datetime.now(timezone.utc).date()
+    today = today_utc.isoformat()
 
+    # 走势图仅随邮件发送，未配置 SMTP 时只需最新数据
+    latest_data = get_all_latest(INDEXES, today_utc, with_chart=bool(config['SMTP_SERVER']))
     for ticker in INDEXES:
-        result = get_latest_data(ticker)
+        result = latest_data.get(ticker)
         if result is None:
             continue
         latest, hist = result
-        charts[ticker] = make_chart(ticker, hist)
+        hists[ticker] = hist
         change = (latest['Close'] - latest['Open']) / latest['Open']
         row = {
             'Date': today,
@@ -171,13 +469,17 @@ def main():
 
     save_data(config, all_rows)
 
+    # 走势图仅作为邮件附件，未配置 SMTP 时无需渲染
+    if config['SMTP_SERVER'] and (alerts or config['SEND_DAILY_CHART']):
+        charts = make_charts(hists)
+
+    webhooks = enabled_webhooks(config)
+    if not (webhooks or config['SMTP_SERVER']):
+        print("⚠️ 未配置任何推送渠道，跳过日报发送")
+        return
+
     # 构建日报正文
-    summary_lines = []
-    for r in all_rows:
-        summary_lines.append(
-            f"{r['Name']} ({r['Ticker']}): 开盘 {r['Open']:.2f}, 收盘 {r['Close']:.2f}, 涨跌幅 {r['Change']*100:.2f}%"
-        )
-    summary_text = "\n".join(summary_lines)
+    summary_text = "\n".join(_ROW_FMT(**r, pct=r['Change'] * 100) for r in all_rows)
 
     if alerts:
         subject = "📉 市场日报（含警报）"
@@ -186,11 +488,21 @@ def main():
         subject = "📈 市场日报（无异常）"
         body = "📊 今日主要指数表现如下：\n" + summary_text
 
-    # 发送多渠道通知
-    send_email(config, subject, body, charts)
-    send_telegram(config, subject + "\n" + body)
-    send_discord(config, subject + "\n" + body)
-    send_wechat(config, subject + "\n" + body)
+    # 仅对已配置的渠道并发发送通知
+    tasks = []
+    if config['SMTP_SERVER']:
+        tasks.append((send_email, (config, build_email(config, subject, body, charts))))
+    else:
+        print("⚠️ 未配置 SMTP，跳过邮件发送")
+    if webhooks:
+        tasks.append((send_webhooks, (config, subject + "\n" + body, webhooks)))
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        futs = [ex.submit(fn, *args) for fn, args in tasks]
+        for f in as_completed(futs):
+            try:
+                f.result()
+            except Exception as e:
+                print(f"❌ 推送任务异常: {e}")
 
     print("✅ 每日报告发送完成")
 